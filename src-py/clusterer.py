@@ -1,12 +1,21 @@
 import csv
+import os
+import re
 import time
+import uuid
 from utils.ipc import print_progress
-from matplotlib import pyplot as plt
+import matplotlib
+
+# The clusterer runs headless, so plots are only ever rendered to files
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt  # noqa: E402
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
-from sklearn.cluster import AgglomerativeClustering, KMeans
-from sklearn.metrics import silhouette_score
+from scipy.cluster.hierarchy import fcluster, linkage
+from sklearn.cluster import KMeans
 from application_state import ApplicationState
+from embedding_cache import EmbeddingCache
 from loguru import logger
 from collections import Counter
 from models import (
@@ -16,15 +25,28 @@ from models import (
     ManualClusterCount,
     Merger,
     MergingStatistics,
-    OutlierStatistic,
     Response,
     OutlierStatistics,
     SimilarityPair,
     Timesteps,
     ClusteringResult,
     Run,
+    compute_pairwise_similarities,
 )
 
+# Optional GPU backends for large corpora
+try:
+    from cuml.cluster import KMeans as CumlKMeans
+except ImportError:
+    CumlKMeans = None
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+# Minimum number of responses before KMeans is moved to the GPU
+GPU_MIN_RESPONSES = 100_000
+
 
 class Clusterer:
     def __init__(self, app_state: ApplicationState):
@@ -39,6 +61,7 @@ class Clusterer:
         self.output_dir = "output"
         self.timesteps = Timesteps(steps={})
         self.random_state = 42
+        self.embedding_cache = EmbeddingCache()
         print_progress("process_input_file", "todo")
         print_progress("load_model", "todo")
         print_progress("embed_responses", "todo")
@@ -54,14 +77,23 @@ class Clusterer:
     def process_input_file(self, excluded_words: list[str]):
         print_progress("process_input_file", "start")
         response_counter: Counter[str] = Counter()
+        # A single compiled alternation replaces one substring search per excluded word
+        excluded_words = [word.lower() for word in excluded_words if word != ""]
+        excluded_pattern = (
+            re.compile("|".join(re.escape(word) for word in excluded_words))
+            if excluded_words
+            else None
+        )
         try:
             with open(self.file_path, encoding="utf-8") as f:
                 reader = csv.reader(f, delimiter=self.file_settings.delimiter)
                 if self.file_settings.has_header:
                     reader.__next__()
 
+                # Rows are streamed from the reader and only the counts are kept in memory
+                selected_columns = self.file_settings.selected_columns
                 for row in reader:
-                    for column_index in self.file_settings.selected_columns:
+                    for column_index in selected_columns:
                         if column_index >= len(row):
                             logger.warning(
                                 f"Skipping invalid column {column_index} in row {reader.line_num}"
@@ -69,26 +101,24 @@ class Clusterer:
                             continue
                         # get the next entry provided by the current participant
                         response = row[column_index].strip().lower()
-                        if response == "" or response is None:
+                        if not response:
                             continue
-                        for excluded_word in excluded_words:
-                            if (
-                                excluded_word != ""
-                                and excluded_word.lower() in response.lower()
-                            ):
-                                logger.info(
-                                    f"Excluded word found: {excluded_word} in response: {response}"
-                                )
-                                break
-                        # otherwise, count the response
                         response_counter[response] += 1
-            responses = list(response_counter.keys())
+            # Excluded words are matched once per unique response instead of once per row
+            if excluded_pattern:
+                for response in list(response_counter):
+                    match = excluded_pattern.search(response)
+                    if match:
+                        logger.info(
+                            f"Excluded word found: {match.group()} in response: {response}"
+                        )
+                        del response_counter[response]
             responses = [
                 Response(text=response, count=count)
                 for response, count in response_counter.items()
             ]
             print_progress("process_input_file", "complete")
-            self.timesteps.steps["process_input_file"] = time.time()
+            self.timesteps.steps["process_input_file"] = time.monotonic()
             return responses
         except Exception as e:
             print_progress("process_input_file", "error")
@@ -98,9 +128,13 @@ class Clusterer:
     def load_embedding_model(self, language_model: str):
         print_progress("load_model", "start")
         try:
-            model = SentenceTransformer(language_model)
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model = SentenceTransformer(language_model, device=device)
+            if device == "cuda":
+                # Half precision inference runs on the GPU's tensor cores
+                model.half()
             print_progress("load_model", "complete")
-            self.timesteps.steps["load_model"] = time.time()
+            self.timesteps.steps["load_model"] = time.monotonic()
             return model
         except Exception as e:
             print_progress("load_model", "error")
@@ -108,19 +142,41 @@ class Clusterer:
             raise
 
     def embed_responses(
-        self, responses: list[Response], embedding_model: SentenceTransformer
+        self,
+        responses: list[Response],
+        embedding_model: SentenceTransformer,
+        language_model: str,
     ):
         print_progress("embed_responses", "start")
-        # Side Effect: Embeds the responses and sets the embeddings in the Response objects
-        norm_embeddings = embedding_model.encode(
-            [response.text for response in responses], normalize_embeddings=True
+        texts = [response.text for response in responses]
+        # All embeddings live in one contiguous matrix, row i belongs to responses[i]
+        norm_embeddings = np.empty(
+            (len(texts), embedding_model.get_sentence_embedding_dimension()),
+            dtype=np.float32,
+        )
+        # Only embed the responses that are not in the cache yet
+        cached = self.embedding_cache.get_embeddings(
+            language_model, texts, norm_embeddings
         )
-        embeddings_map: dict[str, np.ndarray] = {}
-        for i, response in enumerate(responses):
-            embeddings_map[response.text] = norm_embeddings[i]
+        missing_rows = np.flatnonzero(~cached)
+        if len(missing_rows) > 0:
+            missing_texts = [texts[row] for row in missing_rows.tolist()]
+            # encode sorts the texts by length before batching, which keeps padding low
+            new_embeddings = embedding_model.encode(
+                missing_texts,
+                batch_size=64,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False,
+            )
+            norm_embeddings[missing_rows] = self.embedding_cache.add_embeddings(
+                language_model, missing_texts, new_embeddings
+            )
+        # Renormalize, the quantized storage of the cache perturbs the norms slightly
+        norm_embeddings /= np.linalg.norm(norm_embeddings, axis=1, keepdims=True)
         print_progress("embed_responses", "complete")
-        self.timesteps.steps["embed_responses"] = time.time()
-        return embeddings_map
+        self.timesteps.steps["embed_responses"] = time.monotonic()
+        return norm_embeddings
 
     def detect_outliers(
         self,
@@ -128,60 +184,75 @@ class Clusterer:
         embeddings: np.ndarray,
         outlier_k: int,
         z_score_threshold: float,
+        tile_size: int = 1024,
     ):
         print_progress("detect_outliers", "start")
         # Potential for visualization: plot the distribution of average neighbor similarities
         if len(responses) == 0:
             logger.warning("No responses to analyze for outliers")
             print_progress("detect_outliers", "complete")
-            self.timesteps.steps["detect_outliers"] = time.time()
-            return OutlierStatistics(threshold=0.0, outliers=[])
-        if outlier_k >= len(responses) - 1:
-            outlier_k = len(responses) - 2
-        similarity_matrix = np.dot(embeddings, embeddings.T)
-        partition = np.partition(-similarity_matrix, outlier_k + 1, axis=1)
-        sorted_neighborhood_partition = np.copy(partition)
-        sorted_neighborhood_partition[:, : outlier_k + 1] = np.sort(
-            partition[:, : outlier_k + 1], axis=1
-        )
-        avg_neighbor_sim = np.mean(
-            -sorted_neighborhood_partition[:, 1 : outlier_k + 1], axis=1
-        )
+            self.timesteps.steps["detect_outliers"] = time.monotonic()
+            return OutlierStatistics(threshold=0.0, outliers=[]), []
+        # the self-similarity is masked out, so every response has N - 1 neighbors
+        if outlier_k > len(responses) - 1:
+            outlier_k = len(responses) - 1
+        if faiss is not None:
+            # Exact inner product search, on all available GPUs if there are any
+            index = faiss.IndexFlatIP(embeddings.shape[1])
+            if faiss.get_num_gpus() > 0:
+                index = faiss.index_cpu_to_all_gpus(index)
+            contiguous_embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            index.add(contiguous_embeddings)
+            similarities, _ = index.search(contiguous_embeddings, outlier_k + 1)
+            # the closest neighbor of every response is the response itself
+            avg_neighbor_sim = np.mean(similarities[:, 1:], axis=1, dtype=np.float64)
+        else:
+            # Compute the similarities in row tiles to avoid materializing the full
+            # N x N similarity matrix
+            avg_neighbor_sim = np.empty(len(embeddings))
+            for start in range(0, len(embeddings), tile_size):
+                tile = embeddings[start : start + tile_size]
+                tile_similarities = tile @ embeddings.T
+                # exclude the self-similarity of each response
+                tile_rows = np.arange(len(tile))
+                tile_similarities[tile_rows, start + tile_rows] = -np.inf
+                partition = np.partition(-tile_similarities, outlier_k - 1, axis=1)
+                avg_neighbor_sim[start : start + tile_size] = -np.mean(
+                    partition[:, :outlier_k], axis=1
+                )
 
         outlier_threshold = np.mean(avg_neighbor_sim) - z_score_threshold * np.std(
             avg_neighbor_sim
         )
 
-        outlier_stats = []
-        outlier_bools = avg_neighbor_sim < outlier_threshold
-
-        for index in np.where(outlier_bools)[0]:
-            responses[index].is_outlier = True
-
-        outliers = [response for response in responses if response.is_outlier]
+        outlier_indices = np.flatnonzero(avg_neighbor_sim < outlier_threshold)
 
         outlier_statistics_summary = OutlierStatistics(
             threshold=outlier_threshold, outliers=[]
         )
 
-        for i, response in enumerate(outliers):
-            sim = avg_neighbor_sim[np.where(outlier_bools)[0][i]]
-            outlier_stats.append(
-                OutlierStatistic(
-                    similarity=sim,
-                    response=response,
-                    response_id=response.id,
-                    outlier_statistics_id=outlier_statistics_summary.id,
-                )
+        # The statistics are returned as rows, ClusteringResult.bulk_rows inserts them on save
+        outlier_statistic_rows = []
+        for index, sim, outlier_id in zip(
+            outlier_indices.tolist(),
+            avg_neighbor_sim[outlier_indices].tolist(),
+            uuid4_batch(len(outlier_indices)),
+        ):
+            responses[index].is_outlier = True
+            outlier_statistic_rows.append(
+                {
+                    "id": outlier_id,
+                    "similarity": sim,
+                    "response_id": responses[index].id,
+                    "outlier_statistics_id": outlier_statistics_summary.id,
+                }
             )
 
-        outlier_statistics_summary.outliers = outlier_stats
-
         print_progress("detect_outliers", "complete")
-        self.timesteps.steps["detect_outliers"] = time.time()
-        return outlier_statistics_summary
+        self.timesteps.steps["detect_outliers"] = time.monotonic()
+        return outlier_statistics_summary, outlier_statistic_rows
 
-    def auto_cluster_count(self, embeddings, response_weights):
+    def auto_cluster_count(self, embeddings, response_weights, patience: int = 8):
         print_progress("auto_cluster_count", "start")
         assert self.algorithm_settings.method.cluster_count_method == "auto"
         max_clusters = self.algorithm_settings.method.max_clusters
@@ -201,19 +272,31 @@ class Clusterer:
                 + list(range(110, max_clusters + 1, 10))
             )
 
+        evaluated_K_values = []
         sil_scores, inertias, calinski_scores, bic_scores = [], [], [], []
 
+        # The silhouette score is evaluated on a fixed sample of responses,
+        # so their pairwise cosine distances are computed once for all K
+        sample_indices = np.random.RandomState(self.random_state).permutation(
+            len(embeddings)
+        )[:2000]
+        sample_embeddings = embeddings[sample_indices]
+        sample_distances = 1 - sample_embeddings @ sample_embeddings.T
+        np.fill_diagonal(sample_distances, 0)
+
         for K in K_values:
-            # TODO: improve with early stopping
             if K >= len(embeddings) - 1:
-                continue
-            clustering = KMeans(
-                n_clusters=K, n_init="auto", random_state=self.random_state
-            ).fit(embeddings, sample_weight=response_weights)
+                break
+            clustering = fit_kmeans(
+                embeddings,
+                response_weights,
+                n_clusters=K,
+                random_state=self.random_state,
+            )
             labels = clustering.labels_
 
             # Silhouette Score
-            sil = silhouette_score(embeddings, labels)
+            sil = precomputed_silhouette(sample_distances, labels[sample_indices])
             sil_scores.append(sil)
 
             # Inertia
@@ -221,7 +304,11 @@ class Clusterer:
 
             # Custom Calinski-Harabasz
             calinski = weighted_calinski_harabasz(
-                embeddings, labels, response_weights, clustering.cluster_centers_
+                embeddings,
+                labels,
+                response_weights,
+                clustering.cluster_centers_,
+                inertia=clustering.inertia_,
             )
             calinski_scores.append(calinski)
 
@@ -231,103 +318,106 @@ class Clusterer:
             )
             bic_scores.append(bic)
 
-        # Normalize metrics
-        sil_norm = normalize(sil_scores, higher_better=True)
-        inertia_norm = normalize(inertias, higher_better=False)
-        calinski_norm = normalize(calinski_scores, higher_better=True)
-        bic_norm = normalize(bic_scores, higher_better=False)
-
-        # Combine scores (adjust weights as needed)
-        weights = [0.4, 0.1, 0.4, 0.1]  # Silhouette, Inertia, Calinski, BIC
-        combined_scores = [
-            w * s + w_i * i + w_c * c + w_b * b
-            for s, i, c, b in zip(sil_norm, inertia_norm, calinski_norm, bic_norm)
-            for w, w_i, w_c, w_b in [weights]
-        ]
+            evaluated_K_values.append(K)
 
-        best_idx = np.argmax(combined_scores)
-        best_K = K_values[best_idx]
+            # Stop early once the best combined score has not improved for `patience` K values
+            *_, combined_scores = combine_scores(
+                sil_scores, inertias, calinski_scores, bic_scores
+            )
+            if len(combined_scores) - 1 - np.argmax(combined_scores) > patience:
+                break
 
-        # Plot the results
-        plot_cluster_metrics(
-            K_values,
-            sil_norm,
-            inertia_norm,
-            calinski_norm,
-            bic_norm,
-            combined_scores,
-            best_K,
+        sil_norm, inertia_norm, calinski_norm, bic_norm, combined_scores = (
+            combine_scores(sil_scores, inertias, calinski_scores, bic_scores)
         )
 
+        best_idx = int(np.argmax(combined_scores))
+        best_K = evaluated_K_values[best_idx]
+
+        # Plot the results
+        if self.algorithm_settings.debug_plots:
+            os.makedirs(self.output_dir, exist_ok=True)
+            plot_cluster_metrics(
+                evaluated_K_values,
+                sil_norm,
+                inertia_norm,
+                calinski_norm,
+                bic_norm,
+                combined_scores,
+                best_K,
+                f"{self.output_dir}/cluster_metrics.png",
+            )
+
         print_progress("auto_cluster_count", "complete")
-        self.timesteps.steps["auto_cluster_count"] = time.time()
+        self.timesteps.steps["auto_cluster_count"] = time.monotonic()
         return best_K
 
     def start_clustering(
         self,
         responses: list[Response],
         embeddings: np.ndarray,
-        embeddings_map: dict[str, np.ndarray],
+        text_to_row: dict[str, int],
         K: int,
         response_weights: np.ndarray,
     ):
         print_progress("cluster", "start")
         # Side Effect: Assigns cluster IDs to responses
-        clustering = KMeans(
-            n_clusters=K, n_init="auto", random_state=self.random_state
-        ).fit(embeddings, sample_weight=response_weights)
-        cluster_indices = np.copy(clustering.labels_)
-        valid_clusters = [i for i in range(K) if np.sum(cluster_indices == i) > 0]
-        K = len(valid_clusters)
-        cluster_indices = np.array(
-            [valid_clusters.index(idx) for idx in cluster_indices]
-        )
-        cluster_centers = clustering.cluster_centers_ / np.linalg.norm(
-            clustering.cluster_centers_, axis=1, keepdims=True, ord=2
+        clustering = fit_kmeans(
+            embeddings,
+            response_weights,
+            n_clusters=K,
+            n_init="auto",
+            random_state=self.random_state,
         )
+        # Drop empty clusters and relabel the remaining ones consecutively
+        cluster_counts = np.bincount(clustering.labels_, minlength=K)
+        valid_clusters = np.flatnonzero(cluster_counts > 0)
+        K = len(valid_clusters)
+        relabeling = np.full(len(cluster_counts), -1)
+        relabeling[valid_clusters] = np.arange(K)
+        cluster_indices = relabeling[clustering.labels_]
+        cluster_centers = clustering.cluster_centers_[valid_clusters]
+
+        buckets: list[list[Response]] = [[] for _ in range(K)]
+        for response, cluster_index in zip(responses, cluster_indices):
+            buckets[cluster_index].append(response)
 
         clusters = []
         for i in range(K):
             cluster = Cluster(
-                center=cluster_centers[i].tolist(),
-                responses=[],
+                center=cluster_centers[i],
+                responses=buckets[i],
                 index=i,
             )
-            clusters.append(cluster)
-
-        for i, response in enumerate(responses):
-            cluster_index = cluster_indices[i]
-            response.cluster_id = clusters[cluster_index].id
-            response.similarity = clusters[cluster_index].similarity_to_response(
-                response, embeddings_map
+            similarities = cluster.similarities_to_responses(
+                buckets[i], embeddings, text_to_row
             )
-            clusters[cluster_index].responses.append(response)
+            for response, similarity in zip(buckets[i], similarities.tolist()):
+                response.cluster_id = cluster.id
+                response.similarity = similarity
+            clusters.append(cluster)
 
         print_progress("cluster", "complete")
-        self.timesteps.steps["cluster"] = time.time()
+        self.timesteps.steps["cluster"] = time.monotonic()
         return clusters
 
     def merge_clusters(
         self,
         clusters: list[Cluster],
         similarity_threshold: float,
-        embeddings_map: dict[str, np.ndarray],
+        embeddings: np.ndarray,
+        text_to_row: dict[str, int],
     ):
         print_progress("merge", "start")
         cluster_centers = np.asarray(
-            [np.asarray(cluster.center) for cluster in clusters]
+            [cluster.center for cluster in clusters], dtype=np.float32
         )
+        cluster_counts = np.array([cluster.count for cluster in clusters])
 
-        # merge the closest clusters using Agglomorative Clustering
-        # until everything is closer than the threshold
-        meta_clustering = AgglomerativeClustering(
-            n_clusters=None,
-            distance_threshold=1 - similarity_threshold,
-            linkage="complete",
-            metric="cosine",
-        ).fit(cluster_centers)
-
-        meta_clustering_indices = meta_clustering.labels_
+        # merge the closest clusters until everything is closer than the threshold
+        meta_clustering_indices = complete_linkage_labels(
+            cluster_centers, similarity_threshold
+        )
 
         mergers: list[Merger] = []
         post_merge_cluster_ids = [cluster.id for cluster in clusters]
@@ -337,25 +427,11 @@ class Clusterer:
             )[0].tolist()
             assert isinstance(merged_cluster_indices, list)
             if len(merged_cluster_indices) > 1:
-                S = np.dot(
-                    cluster_centers[merged_cluster_indices, :],
-                    cluster_centers[merged_cluster_indices, :].T,
-                )
-                triu_indices = np.triu_indices(len(S), k=1)
-                similarity_pairs = []
                 merged_clusters: list[Cluster] = [
                     clusters[i]  # type: ignore
                     for i in merged_cluster_indices
                 ]
-                for i, j in zip(triu_indices[0], triu_indices[1]):
-                    similarity_pairs.append(
-                        SimilarityPair(
-                            cluster_1_id=merged_clusters[i].id,
-                            cluster_2_id=merged_clusters[j].id,
-                            similarity=S[i, j],
-                        )
-                    )
-                similarity_pairs.sort(key=lambda x: x.similarity, reverse=True)
+                similarity_pairs = sorted_similarity_pairs(merged_clusters)
                 merger = Merger(
                     clusters=merged_clusters,
                     similarity_pairs=similarity_pairs,
@@ -363,28 +439,35 @@ class Clusterer:
                 mergers.append(merger)
 
                 new_center = np.average(
-                    [cluster.center for cluster in merged_clusters],
+                    cluster_centers[merged_cluster_indices],
                     axis=0,
-                    weights=[cluster.count for cluster in merged_clusters],
+                    weights=cluster_counts[merged_cluster_indices],
                 )
 
                 merged_cluster = Cluster(
-                    center=new_center.tolist(),
+                    center=new_center.astype(np.float32),
                     index=merged_clusters[0].index,
                     is_merger_result=True,
                 )
 
+                merged_responses = [
+                    response
+                    for cluster in merged_clusters
+                    for response in cluster.responses
+                ]
+                similarities = merged_cluster.similarities_to_responses(
+                    merged_responses, embeddings, text_to_row
+                )
                 merged_cluster.responses = [
                     Response(
                         text=response.text,
                         cluster_id=merged_cluster.id,
                         count=response.count,
-                        similarity=merged_cluster.similarity_to_response(
-                            response, embeddings_map
-                        ),
+                        similarity=similarity,
+                    )
+                    for response, similarity in zip(
+                        merged_responses, similarities.tolist()
                     )
-                    for cluster in merged_clusters
-                    for response in cluster.responses
                 ]
 
                 post_merge_cluster_ids.append(merged_cluster.id)
@@ -400,50 +483,43 @@ class Clusterer:
             mergers=mergers, threshold=similarity_threshold
         )
         print_progress("merge", "complete")
-        self.timesteps.steps["merge"] = time.time()
+        self.timesteps.steps["merge"] = time.monotonic()
         return merging_statistics, clusters
 
-    def calculate_inter_cluster_similarities(self, clusters: list[Cluster]):
+    def calculate_inter_cluster_similarities(
+        self, clusters: list[Cluster], result_id: uuid.UUID
+    ):
         # Calculate the similarity between all pairs of clusters
-        cluster_centers = np.asarray(
-            [np.asarray(cluster.center) for cluster in clusters]
-        )
-        S = np.dot(cluster_centers, cluster_centers.T)
-        triu_indices = np.triu_indices(len(S), k=1)
-        cluster_similarity_pairs = []
-        for i, j in zip(triu_indices[0], triu_indices[1]):
-            cluster_similarity_pairs.append(
-                SimilarityPair(
-                    cluster_1_id=clusters[i].id,
-                    cluster_2_id=clusters[j].id,
-                    similarity=S[i, j],
-                )
-            )
-        return cluster_similarity_pairs
+        return sorted_similarity_rows(clusters, result_id=result_id)
 
     def run(self) -> ClusteringResult:
         print_progress("start", "start")
-        self.timesteps.steps["start"] = time.time()
+        self.timesteps.steps["start"] = time.monotonic()
         responses = self.process_input_file([])
 
-        embedding_model = self.load_embedding_model("BAAI/bge-large-en-v1.5")
+        language_model = "BAAI/bge-large-en-v1.5"
+        embedding_model = self.load_embedding_model(language_model)
 
-        embeddings_map = self.embed_responses(responses, embedding_model)
-        embeddings = np.asarray(list(embeddings_map.values()))
+        norm_embeddings = self.embed_responses(
+            responses, embedding_model, language_model
+        )
 
-        outlier_stats = self.detect_outliers(
+        outlier_stats, outlier_statistic_rows = self.detect_outliers(
             responses,
-            embeddings,
+            norm_embeddings,
             outlier_k=5,
             z_score_threshold=1.5,
         )
 
         # Update responses to exclude outliers
+        keep_mask = np.array(
+            [not response.is_outlier for response in responses], dtype=bool
+        )
+        outlier_responses = [response for response in responses if response.is_outlier]
         responses = [response for response in responses if not response.is_outlier]
-        embeddings_map = {
-            response.text: embeddings_map[response.text] for response in responses
-        }
-        embeddings = np.asarray(list(embeddings_map.values()))
+        embeddings = norm_embeddings[keep_mask]
+        # Response texts are unique, each one maps to its row in the filtered embeddings
+        text_to_row = {response.text: i for i, response in enumerate(responses)}
 
         response_weights = np.array([response.count for response in responses])
 
@@ -453,76 +529,202 @@ class Clusterer:
             K = self.algorithm_settings.method.cluster_count
 
         clusters = self.start_clustering(
-            responses, embeddings, embeddings_map, K, response_weights
+            responses, embeddings, text_to_row, K, response_weights
         )
 
         merger_stats, clusters = self.merge_clusters(
-            clusters, similarity_threshold=0.85, embeddings_map=embeddings_map
+            clusters,
+            similarity_threshold=0.85,
+            embeddings=embeddings,
+            text_to_row=text_to_row,
         )
 
-        for cluster in clusters:
-            cluster.center = (
-                np.asarray(cluster.center)
-                / np.linalg.norm(
-                    np.asarray(cluster.center),
-                    ord=2,
-                    axis=0,
-                )
-            ).tolist()
-            for response in cluster.responses:
-                response.cluster_id = cluster.id
-                response.similarity = cluster.similarity_to_response(
-                    response, embeddings_map
-                )
+        # Cluster centers are normalized on construction, so the response similarities
+        # computed during clustering and merging are already final
 
-        return ClusteringResult(
+        result = ClusteringResult(
             clusters=clusters,
             outlier_statistics=outlier_stats,
             merger_statistics=merger_stats,
-            inter_cluster_similarities=self.calculate_inter_cluster_similarities(
-                clusters
-            ),
             timesteps=self.timesteps,
         )
+        result.bulk_rows.outlier_responses = outlier_responses
+        result.bulk_rows.outlier_statistics = outlier_statistic_rows
+        result.bulk_rows.similarity_pairs = self.calculate_inter_cluster_similarities(
+            clusters, result.id
+        )
+        return result
 
 
 def plot_cluster_metrics(
-    K_values, sil_norm, inertia_norm, calinski_norm, bic_norm, combined_scores, best_K
+    K_values,
+    sil_norm,
+    inertia_norm,
+    calinski_norm,
+    bic_norm,
+    combined_scores,
+    best_K,
+    file_path,
 ):
-    plt.figure(figsize=(12, 6))
-    plt.plot(K_values, sil_norm, label="Silhouette (Normalized)", marker="o")
-    plt.plot(K_values, inertia_norm, label="Inverted Inertia (Normalized)", marker="s")
-    plt.plot(
-        K_values, calinski_norm, label="Calinski-Harabasz (Normalized)", marker="^"
-    )
-    plt.plot(K_values, bic_norm, label="Inverted BIC (Normalized)", marker="v")
-    plt.plot(
+    fig, ax = plt.subplots(figsize=(12, 6))
+    ax.plot(K_values, sil_norm, label="Silhouette (Normalized)", marker="o")
+    ax.plot(K_values, inertia_norm, label="Inverted Inertia (Normalized)", marker="s")
+    ax.plot(K_values, calinski_norm, label="Calinski-Harabasz (Normalized)", marker="^")
+    ax.plot(K_values, bic_norm, label="Inverted BIC (Normalized)", marker="v")
+    ax.plot(
         K_values,
         combined_scores,
         label="Combined Score",
         linestyle="--",
         marker="x",
     )
-    plt.axvline(best_K, color="r", linestyle=":", label=f"Optimal K={best_K}")
-    plt.xlabel("Number of Clusters (K)")
-    plt.ylabel("Normalized Score")
-    plt.title("Clustering Evaluation Metrics")
-    plt.legend()
-    plt.grid(True)
+    ax.axvline(best_K, color="r", linestyle=":", label=f"Optimal K={best_K}")
+    ax.set_xlabel("Number of Clusters (K)")
+    ax.set_ylabel("Normalized Score")
+    ax.set_title("Clustering Evaluation Metrics")
+    ax.legend()
+    ax.grid(True)
+    fig.savefig(file_path)
+    # release the figure, pyplot would otherwise keep it alive across runs
+    plt.close(fig)
+
+
+def fit_kmeans(
+    embeddings,
+    sample_weight,
+    n_clusters,
+    n_init="auto",
+    random_state=None,
+):
+    # Large corpora are clustered on the GPU if cuML is installed
+    if CumlKMeans is not None and len(embeddings) >= GPU_MIN_RESPONSES:
+        return CumlKMeans(
+            n_clusters=n_clusters,
+            n_init=1 if n_init == "auto" else n_init,
+            random_state=random_state,
+        ).fit(np.asarray(embeddings, dtype=np.float32), sample_weight=sample_weight)
+    return KMeans(
+        n_clusters=n_clusters,
+        n_init=n_init,
+        random_state=random_state,
+    ).fit(embeddings, sample_weight=sample_weight)
+
+
+def precomputed_silhouette(distances, labels):
+    # Mean silhouette coefficient from a precomputed pairwise distance matrix
+    one_hot = np.zeros((len(labels), labels.max() + 1), dtype=distances.dtype)
+    one_hot[np.arange(len(labels)), labels] = 1
+    cluster_sizes = one_hot.sum(axis=0)
+    # summed distance of every sample to all members of each cluster
+    distance_sums = distances @ one_hot
+
+    own_sizes = cluster_sizes[labels]
+    own_sums = distance_sums[np.arange(len(labels)), labels]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        intra = own_sums / (own_sizes - 1)
+        mean_distances = distance_sums / cluster_sizes
+    mean_distances[:, cluster_sizes == 0] = np.inf
+    mean_distances[np.arange(len(labels)), labels] = np.inf
+    inter = mean_distances.min(axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (inter - intra) / np.maximum(intra, inter)
+    # samples in singleton clusters, or without any other cluster, score 0
+    scores[(own_sizes == 1) | np.isinf(inter)] = 0
+    return float(np.mean(scores))
+
+
+def combine_scores(sil_scores, inertias, calinski_scores, bic_scores):
+    # Normalize metrics
+    sil_norm = normalize(sil_scores, higher_better=True)
+    inertia_norm = normalize(inertias, higher_better=False)
+    calinski_norm = normalize(calinski_scores, higher_better=True)
+    bic_norm = normalize(bic_scores, higher_better=False)
+
+    # Combine scores (adjust weights as needed)
+    weights = np.array([0.4, 0.1, 0.4, 0.1])  # Silhouette, Inertia, Calinski, BIC
+    combined_scores = (
+        np.stack([sil_norm, inertia_norm, calinski_norm, bic_norm], axis=1) @ weights
+    )
+    return sil_norm, inertia_norm, calinski_norm, bic_norm, combined_scores
+
+
+def sorted_similarity_pairs(clusters):
+    return [SimilarityPair(**row) for row in sorted_similarity_rows(clusters)]
+
+
+def sorted_similarity_rows(clusters, **columns):
+    # Similarity pair rows for the upper triangle of the similarity matrix, most similar first
+    S = compute_pairwise_similarities(clusters)
+    i_indices, j_indices = np.triu_indices(len(S), k=1)
+    similarities = S[i_indices, j_indices]
+    order = np.argsort(-similarities, kind="stable")
+    cluster_ids = [cluster.id for cluster in clusters]
+    return [
+        {
+            "id": pair_id,
+            "cluster_1_id": cluster_ids[i],
+            "cluster_2_id": cluster_ids[j],
+            "similarity": similarity,
+            **columns,
+        }
+        for i, j, similarity, pair_id in zip(
+            i_indices[order].tolist(),
+            j_indices[order].tolist(),
+            similarities[order].tolist(),
+            uuid4_batch(len(order)),
+        )
+    ]
+
+
+def complete_linkage_labels(cluster_centers, similarity_threshold):
+    # Complete linkage on cosine distances, groups are merged while their farthest
+    # members are closer than 1 - similarity_threshold
+    if len(cluster_centers) < 2:
+        return np.zeros(len(cluster_centers), dtype=int)
+    cluster_centers = np.asarray(cluster_centers, dtype=np.float64)
+    normalized_centers = cluster_centers / np.linalg.norm(
+        cluster_centers, axis=1, keepdims=True
+    )
+    # condensed cosine distances from one matrix product, faster than pdist for wide vectors
+    i_indices, j_indices = np.triu_indices(len(cluster_centers), k=1)
+    distances = 1 - (normalized_centers @ normalized_centers.T)[i_indices, j_indices]
+    merge_tree = linkage(np.maximum(distances, 0), method="complete")
+    # fcluster keeps merges at or below t, AgglomerativeClustering only those below it
+    distance_threshold = np.nextafter(1 - similarity_threshold, -np.inf)
+    return fcluster(merge_tree, t=distance_threshold, criterion="distance")
+
+
+def uuid4_batch(count):
+    # Random version 4 UUIDs for bulk inserted rows, drawn from a single urandom call
+    random_bytes = np.frombuffer(
+        bytearray(os.urandom(16 * count)), dtype=np.uint8
+    ).reshape(count, 16)
+    # set the version and variant bits like uuid.uuid4
+    random_bytes[:, 6] = (random_bytes[:, 6] & 0x0F) | 0x40
+    random_bytes[:, 8] = (random_bytes[:, 8] & 0x3F) | 0x80
+    uuid_bytes = random_bytes.tobytes()
+    return [
+        uuid.UUID(bytes=uuid_bytes[start : start + 16])
+        for start in range(0, len(uuid_bytes), 16)
+    ]
 
 
 # Normalization function
 def normalize(scores, higher_better=True):
-    min_val, max_val = min(scores), max(scores)
+    scores = np.asarray(scores, dtype=np.float64)
+    min_val, max_val = scores.min(), scores.max()
     if max_val == min_val:
-        return [0.5] * len(scores)
+        return np.full_like(scores, 0.5)
     if higher_better:
-        return [(x - min_val) / (max_val - min_val) for x in scores]
+        return (scores - min_val) / (max_val - min_val)
     else:
-        return [(max_val - x) / (max_val - min_val) for x in scores]
+        return (max_val - scores) / (max_val - min_val)
 
 
-def weighted_calinski_harabasz(embeddings, labels, sample_weight, cluster_centers):
+def weighted_calinski_harabasz(
+    embeddings, labels, sample_weight, cluster_centers, inertia=None
+):
     overall_centroid = np.average(embeddings, weights=sample_weight, axis=0)
     K = len(cluster_centers)
     N = np.sum(sample_weight)
@@ -531,20 +733,17 @@ def weighted_calinski_harabasz(embeddings, labels, sample_weight, cluster_center
         return 0.0
 
     # Between-cluster dispersion
-    B = 0.0
-    for label in range(K):
-        mask = labels == label
-        cluster_weight = sample_weight[mask].sum()
-        centroid_diff = cluster_centers[label] - overall_centroid
-        B += cluster_weight * np.sum(centroid_diff**2)
+    cluster_weights = np.bincount(labels, weights=sample_weight, minlength=K)
+    centroid_diffs = cluster_centers - overall_centroid
+    B = np.sum(cluster_weights * np.einsum("ij,ij->i", centroid_diffs, centroid_diffs))
 
     # Within-cluster dispersion (inertia)
-    W = np.sum(
-        [
-            sample_weight[i] * np.sum((x - cluster_centers[label]) ** 2)
-            for i, (x, label) in enumerate(zip(embeddings, labels))
-        ]
-    )
+    if inertia is not None:
+        # the weighted inertia of a KMeans fit is exactly W, no need for another pass
+        W = inertia
+    else:
+        diffs = embeddings - cluster_centers[labels]
+        W = np.sum(sample_weight * np.einsum("ij,ij->i", diffs, diffs))
 
     return (B / (K - 1)) / (W / (N - K)) if (W != 0 and K != 1) else 0.0
 
@@ -142,6 +142,9 @@ class Controller:
                 if not run_id:
                     print_message("error", Error(error="Run ID not set"))
                     return
+                similarity_pairs = self.database_manager.get_similarity_pairs_by_cluster(
+                    session, run_id
+                )
                 print_message(
                     "cluster_similarities",
                     ClusterSimilaritiesMessage(
@@ -152,7 +155,7 @@ class Controller:
                                 name=cluster.name,
                                 is_merger_result=cluster.is_merger_result,
                                 responses=cluster.responses,
-                                similarity_pairs=cluster.similarity_pairs,
+                                similarity_pairs=similarity_pairs.get(cluster.id, {}),
                                 count=cluster.count,
                             )
                             for cluster in self.database_manager.get_cluster_similarities(
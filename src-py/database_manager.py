@@ -1,18 +1,25 @@
 import csv
 import time
 import uuid
+from sqlalchemy import insert
+from sqlalchemy.orm import raiseload, selectinload
+from sqlalchemy.orm.attributes import flag_modified
 from sqlmodel import create_engine, SQLModel, Session, select
 from models import (
+    BulkRows,
     Cluster,
     ClusteringResult,
     FileSettings,
+    Merger,
+    OutlierStatistic,
     OutlierStatistics,
     MergingStatistics,
     Run,
+    SimilarityPair,
     Timesteps,
 )
 import os
-from utils.utils import get_user_data_path
+from utils.utils import get_user_data_path, is_production_environment
 from utils.ipc import print_progress
 
 
@@ -24,6 +31,9 @@ class DatabaseManager:
                 f.write("")
         self.engine = create_engine(f"sqlite:///{sql_file_name}", echo=echo)
         SQLModel.metadata.create_all(self.engine)
+        # During development, any relationship that a message query does not load
+        # eagerly raises instead of silently issuing one query per object
+        self.lazy_load_guard = [] if is_production_environment() else [raiseload("*")]
 
     def get_engine(self):
         return self.engine
@@ -40,8 +50,19 @@ class DatabaseManager:
         print_progress("save", "start")
         try:
             session.add(run)
+            bulk_rows = run.result.bulk_rows if run.result else BulkRows()
+            # Outlier responses belong to no cluster, so they are not reached through the run
+            session.add_all(bulk_rows.outlier_responses)
+            # The rows reference the run's objects, so those have to be inserted first
+            session.flush()
+            if bulk_rows.outlier_statistics:
+                session.execute(insert(OutlierStatistic), bulk_rows.outlier_statistics)
+            if bulk_rows.similarity_pairs:
+                session.execute(insert(SimilarityPair), bulk_rows.similarity_pairs)
             print_progress("save", "complete")
-            timesteps.steps["save"] = time.time()
+            timesteps.steps["save"] = time.monotonic()
+            # in-place changes of JSON columns are not tracked
+            flag_modified(timesteps, "steps")
             session.commit()
         except:
             print_progress("save", "error")
@@ -76,6 +97,7 @@ class DatabaseManager:
             select(Cluster)
             .join(ClusteringResult)
             .where(ClusteringResult.run_id == run_id)
+            .options(selectinload(Cluster.responses), *self.lazy_load_guard)
         ).all()
 
     def get_cluster_similarities(self, session: Session, run_id: uuid.UUID):
@@ -84,16 +106,42 @@ class DatabaseManager:
                 select(Cluster)
                 .join(ClusteringResult)
                 .where(ClusteringResult.run_id == run_id)
+                .options(selectinload(Cluster.responses), *self.lazy_load_guard)
             )
             .unique()
             .all()
         )
 
+    def get_similarity_pairs_by_cluster(
+        self, session: Session, run_id: uuid.UUID
+    ) -> dict[uuid.UUID, dict[uuid.UUID, float]]:
+        # Loads all inter-cluster similarities of a run in a single query
+        pairs = session.exec(
+            select(
+                SimilarityPair.cluster_1_id,
+                SimilarityPair.cluster_2_id,
+                SimilarityPair.similarity,
+            )
+            .join(ClusteringResult)
+            .where(ClusteringResult.run_id == run_id)
+        ).all()
+        similarity_pairs: dict[uuid.UUID, dict[uuid.UUID, float]] = {}
+        for cluster_1_id, cluster_2_id, similarity in pairs:
+            similarity_pairs.setdefault(cluster_1_id, {})[cluster_2_id] = similarity
+            similarity_pairs.setdefault(cluster_2_id, {})[cluster_1_id] = similarity
+        return similarity_pairs
+
     def get_outlier_statistics(self, session: Session, run_id: uuid.UUID):
         return session.exec(
             select(OutlierStatistics)
             .join(ClusteringResult)
             .where(ClusteringResult.run_id == run_id)
+            .options(
+                selectinload(OutlierStatistics.outliers).selectinload(
+                    OutlierStatistic.response
+                ),
+                *self.lazy_load_guard,
+            )
         ).one()
 
     def get_merger_statistics(
@@ -104,6 +152,15 @@ class DatabaseManager:
                 select(MergingStatistics)
                 .join(ClusteringResult)
                 .where(ClusteringResult.run_id == run_id)
+                .options(
+                    selectinload(MergingStatistics.mergers)
+                    .selectinload(Merger.clusters)
+                    .selectinload(Cluster.responses),
+                    selectinload(MergingStatistics.mergers).selectinload(
+                        Merger.similarity_pairs
+                    ),
+                    *self.lazy_load_guard,
+                )
             )
         ).one()
 
@@ -134,13 +191,14 @@ class DatabaseManager:
                     # get the next response provided by the current participant
                     text = row[i]
                     response = response_text_map.get(text.strip().lower())
-                    if response is None or response.cluster is None:
+                    if response is None or response.cluster_id is None:
                         row.append("")
                         continue
                     # TODO: need an index for the cluster
-                    row.append(response.cluster.id.hex)
+                    row.append(response.cluster_id.hex)
                 rows.append(row)
 
+        os.makedirs(os.path.dirname(run.output_file_path), exist_ok=True)
         with open(run.output_file_path, "w", encoding="utf-8") as f:
             writer = csv.writer(
                 f, delimiter=file_settings.delimiter, lineterminator="\n"
@@ -165,6 +223,7 @@ class DatabaseManager:
         file_settings = FileSettings.model_validate_json(run.file_settings)
         clusters = run.result.clusters
 
+        os.makedirs(os.path.dirname(run.assignments_file_path), exist_ok=True)
         with open(run.assignments_file_path, "w", encoding="utf-8") as f:
             writer = csv.writer(
                 f, delimiter=file_settings.delimiter, lineterminator="\n"
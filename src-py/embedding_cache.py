@@ -0,0 +1,80 @@
+import hashlib
+import sqlite3
+import numpy as np
+from utils.utils import get_user_data_path
+
+
+class EmbeddingCache:
+    # SQLite limits the number of bound parameters per statement
+    QUERY_BATCH_SIZE = 500
+
+    def __init__(self):
+        cache_file_name = get_user_data_path() + "/embedding_cache.db"
+        self.connection = sqlite3.connect(cache_file_name)
+        with self.connection:
+            self.connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS embedding (
+                    model TEXT NOT NULL,
+                    text_hash BLOB NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                )
+                """
+            )
+
+    def get_embeddings(
+        self, model: str, texts: list[str], embeddings: np.ndarray
+    ) -> np.ndarray:
+        # Writes the cached embeddings into the matching rows of the (texts x dim) matrix
+        # and returns a mask of the rows that were found
+        hashes = {hash_text(text): row for row, text in enumerate(texts)}
+        hash_list = list(hashes.keys())
+        found = np.zeros(len(texts), dtype=bool)
+        for start in range(0, len(hash_list), self.QUERY_BATCH_SIZE):
+            batch = hash_list[start : start + self.QUERY_BATCH_SIZE]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"SELECT text_hash, embedding FROM embedding WHERE model = ? AND text_hash IN ({placeholders})",
+                [model, *batch],
+            )
+            for text_hash, embedding in rows:
+                row = hashes[text_hash]
+                embeddings[row] = dequantize(embedding)
+                found[row] = True
+        return found
+
+    def add_embeddings(
+        self, model: str, texts: list[str], embeddings: np.ndarray
+    ) -> np.ndarray:
+        # Returns the embeddings as they will be read back from the cache, so that a run
+        # gives the same results whether or not its embeddings were cached
+        scales, quantized = quantize(embeddings)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embedding (model, text_hash, embedding) VALUES (?, ?, ?)",
+                [
+                    (model, hash_text(text), scale.tobytes() + values.tobytes())
+                    for text, scale, values in zip(texts, scales, quantized)
+                ],
+            )
+        return quantized * scales
+
+
+def quantize(embeddings: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Symmetric int8 quantization with one float32 scale per embedding, a quarter of the
+    # float32 size. Cosine similarities of normalized embeddings shift by about 1e-3.
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    scales = np.abs(embeddings).max(axis=1, keepdims=True) / 127
+    scales = np.maximum(scales, np.finfo(np.float32).tiny)
+    quantized = np.round(embeddings / scales).astype(np.int8)
+    return scales, quantized
+
+
+def dequantize(embedding: bytes) -> np.ndarray:
+    scale = np.frombuffer(embedding, dtype=np.float32, count=1)[0]
+    return np.frombuffer(embedding, dtype=np.int8, offset=4) * scale
+
+
+def hash_text(text: str) -> bytes:
+    return hashlib.sha256(text.encode("utf-8")).digest()
@@ -1,8 +1,19 @@
-import os
+import json
 import random
-from typing import Literal, Optional, Union
-from pydantic import BaseModel, ConfigDict, computed_field
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Annotated, Literal, Optional, Union
+from pydantic import (
+    BaseModel,
+    ConfigDict,
+    PlainSerializer,
+    PlainValidator,
+    PrivateAttr,
+    computed_field,
+)
 from pydantic.alias_generators import to_camel
+from pydantic.dataclasses import dataclass as pydantic_dataclass
+from sqlalchemy.types import LargeBinary, TypeDecorator
 from sqlmodel import JSON, Column, SQLModel, Field, Relationship
 import numpy as np
 import time
@@ -16,6 +27,33 @@ class CamelModel(BaseModel):
     )
 
 
+class Float32Array(TypeDecorator):
+    # Stores vectors as raw float32 bytes and loads them back as numpy arrays
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return np.asarray(value, dtype=np.float32).tobytes()
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            # vectors saved before the binary format were stored as JSON lists
+            return np.asarray(json.loads(value), dtype=np.float32)
+        return np.frombuffer(value, dtype=np.float32)
+
+
+# Converts the whole vector in one call instead of validating every element as a float
+NDArrayFloat32 = Annotated[
+    np.ndarray,
+    PlainValidator(lambda value: np.asarray(value, dtype=np.float32)),
+    PlainSerializer(lambda array: array.tolist(), return_type=list[float]),
+]
+
+
 ActionType = Literal[
     "set_file_path",
     "get_file_path",
@@ -102,8 +140,12 @@ class CurrentRunMessage(BaseModel):
     timesteps: "Timesteps"
 
 
+# The message detail classes are slotted pydantic dataclasses instead of models, one
+# instance is created per cluster, outlier or merger in every message. They are still
+# validated on construction.
 class ClusterAssignmentsMessage(BaseModel):
-    class ClusterAssignmentDetail(BaseModel):
+    @pydantic_dataclass(slots=True)
+    class ClusterAssignmentDetail:
         id: uuid.UUID
         index: int
         name: str
@@ -115,7 +157,8 @@ class ClusterAssignmentsMessage(BaseModel):
 
 
 class ClusterSimilaritiesMessage(BaseModel):
-    class ClusterSimilarityDetail(BaseModel):
+    @pydantic_dataclass(slots=True)
+    class ClusterSimilarityDetail:
         id: uuid.UUID
         index: int
         name: str
@@ -128,7 +171,8 @@ class ClusterSimilaritiesMessage(BaseModel):
 
 
 class OutliersMessage(BaseModel):
-    class OutlierDetail(BaseModel):
+    @pydantic_dataclass(slots=True)
+    class OutlierDetail:
         id: uuid.UUID
         response: "Response"
         similarity: float
@@ -138,8 +182,10 @@ class OutliersMessage(BaseModel):
 
 
 class MergersMessage(BaseModel):
-    class MergerDetail(BaseModel):
-        class ClusterMergerDetail(BaseModel):
+    @pydantic_dataclass(slots=True)
+    class MergerDetail:
+        @pydantic_dataclass(slots=True)
+        class ClusterMergerDetail:
             id: uuid.UUID
             name: str
             responses: list["Response"]
@@ -222,6 +268,7 @@ class AlgorithmSettings(CamelModel):
     seed: int = Field(default_factory=lambda: random.randint(0, 1000))
     outlier_detection: Optional[OutlierDetectionSettings] = None
     agglomerative_clustering: Optional[AgglomerativeClusteringSettings] = None
+    debug_plots: bool = False
 
 
 class Response(SQLModel, table=True):
@@ -243,7 +290,9 @@ class OutlierStatistic(SQLModel, table=True):
     similarity: float
 
     response_id: uuid.UUID = Field(foreign_key="response.id")
-    response: Response = Relationship(back_populates="outlier_statistic")
+    response: Response = Relationship(
+        back_populates="outlier_statistic", sa_relationship_kwargs={"lazy": "selectin"}
+    )
 
     outlier_statistics_id: uuid.UUID = Field(foreign_key="outlierstatistics.id")
     outlier_statistics: "OutlierStatistics" = Relationship(back_populates="outliers")
@@ -252,7 +301,9 @@ class OutlierStatistic(SQLModel, table=True):
 class OutlierStatistics(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     threshold: float
-    outliers: list[OutlierStatistic] = Relationship(back_populates="outlier_statistics")
+    outliers: list[OutlierStatistic] = Relationship(
+        back_populates="outlier_statistics", sa_relationship_kwargs={"lazy": "selectin"}
+    )
 
     clustering_result_id: Optional[uuid.UUID] = Field(
         default=None, foreign_key="clusteringresult.id"
@@ -297,29 +348,52 @@ class Cluster(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     index: int
     name: str = ""
-    center: list[float] = Field(sa_column=Column(JSON))
-    responses: list[Response] = Relationship(back_populates="cluster")
+    center: NDArrayFloat32 = Field(sa_column=Column(Float32Array))
+    responses: list[Response] = Relationship(
+        back_populates="cluster", sa_relationship_kwargs={"lazy": "selectin"}
+    )
     is_merger_result: bool = False
 
     def __init__(self, **data):
+        # Table models skip validation, so the default name is filled in before construction
+        if not data.get("name"):
+            data["name"] = f"Cluster {data.get('index')}"
         super().__init__(**data)
-        # self.name = f"Cluster {self.id}"
-        self.__dict__["name"] = (
-            f"Cluster {self.index}"  # Bypass frozen for initialization
-        )
+        # Invariant: centers are unit-normalized, so all cosine similarities are plain dot products
+        center = np.asarray(self.center, dtype=np.float32)
+        self.center = center / (np.linalg.norm(center) + 1e-12)
 
     @computed_field
     @property
     def count(self) -> int:
         return sum(response.count for response in self.responses)
 
+    def similarities_to_responses(
+        self,
+        responses: list[Response],
+        embeddings: np.ndarray,
+        text_to_row: dict[str, int],
+    ) -> np.ndarray:
+        # One matrix-vector product for all responses, rows are looked up by response text
+        rows = np.fromiter(
+            (text_to_row[response.text] for response in responses),
+            dtype=np.int64,
+            count=len(responses),
+        )
+        return embeddings[rows] @ self.center
+
     def similarity_to_response(
-        self, response: Response, embeddings_map: dict[str, np.ndarray]
+        self,
+        response: Response,
+        embeddings: np.ndarray,
+        text_to_row: dict[str, int],
     ) -> float:
-        return np.dot(self.center, embeddings_map[response.text])
+        return float(
+            self.similarities_to_responses([response], embeddings, text_to_row)[0]
+        )
 
     def similarity_to_cluster(self, cluster: "Cluster") -> float:
-        return np.dot(self.center, cluster.center)
+        return float(compute_pairwise_similarities([self, cluster])[0, 1])
 
     result_id: Optional[uuid.UUID] = Field(
         default=None, foreign_key="clusteringresult.id"
@@ -342,41 +416,40 @@ class Cluster(SQLModel, table=True):
         },
     )
 
-    @computed_field
-    @property
-    def similarity_pairs(self) -> dict[uuid.UUID, float]:
-        # return self.similarity_pairs_as_cluster_1 + self.similarity_pairs_as_cluster_2
-        dict_1 = {
-            pair.cluster_2.id: pair.similarity
-            for pair in self.similarity_pairs_as_cluster_1
-        }
-        dict_2 = {
-            pair.cluster_1.id: pair.similarity
-            for pair in self.similarity_pairs_as_cluster_2
-        }
-        dict_1.update(dict_2)
-        return dict_1
+
+def compute_pairwise_similarities(clusters: list[Cluster]) -> np.ndarray:
+    # Similarities between all pairs of clusters as a single matrix product
+    centers = np.asarray([cluster.center for cluster in clusters], dtype=np.float32)
+    return np.clip(centers @ centers.T, -1.0, 1.0)
 
 
 class Merger(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     name: str = ""
-    clusters: list[Cluster] = Relationship(back_populates="merger")
-    similarity_pairs: list[SimilarityPair] = Relationship(back_populates="merger")
+    clusters: list[Cluster] = Relationship(
+        back_populates="merger", sa_relationship_kwargs={"lazy": "selectin"}
+    )
+    similarity_pairs: list[SimilarityPair] = Relationship(
+        back_populates="merger", sa_relationship_kwargs={"lazy": "selectin"}
+    )
 
     merging_statistics_id: uuid.UUID = Field(foreign_key="mergingstatistics.id")
     merging_statistics: "MergingStatistics" = Relationship(back_populates="mergers")
 
     def __init__(self, **data):
+        # The default name uses the id, so the id is generated up front
+        data.setdefault("id", uuid.uuid4())
+        if not data.get("name"):
+            data["name"] = f"Merger {data['id']}"
         super().__init__(**data)
-        # self.name = f"Merger {self.id}"
-        self.__dict__["name"] = f"Merger {self.id}"  # Bypass frozen for initialization
 
 
 class MergingStatistics(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     threshold: float
-    mergers: list[Merger] = Relationship(back_populates="merging_statistics")
+    mergers: list[Merger] = Relationship(
+        back_populates="merging_statistics", sa_relationship_kwargs={"lazy": "selectin"}
+    )
 
     clustering_result_id: Optional[uuid.UUID] = Field(
         default=None, foreign_key="clusteringresult.id"
@@ -388,6 +461,7 @@ class MergingStatistics(SQLModel, table=True):
 
 class Timesteps(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    # Steps are recorded with time.monotonic, so only their differences are meaningful
     steps: dict[ClusteringStepType, float] = Field(sa_column=Column(JSON))
 
     @computed_field
@@ -405,6 +479,14 @@ class Timesteps(SQLModel, table=True):
     clustering_result: "ClusteringResult" = Relationship(back_populates="timesteps")
 
 
+@dataclass(slots=True)
+class BulkRows:
+    # Rows of a new result that are bulk inserted on save instead of one ORM object each
+    outlier_responses: list[Response] = field(default_factory=list)
+    outlier_statistics: list[dict] = field(default_factory=list)
+    similarity_pairs: list[dict] = field(default_factory=list)
+
+
 class ClusteringResult(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     clusters: list[Cluster] = Relationship(back_populates="result")
@@ -422,6 +504,15 @@ class ClusteringResult(SQLModel, table=True):
     run_id: Optional[uuid.UUID] = Field(default=None, foreign_key="run.id")
     run: "Run" = Relationship(back_populates="result")
 
+    _bulk_rows: BulkRows = PrivateAttr(default_factory=BulkRows)
+
+    @property
+    def bulk_rows(self) -> BulkRows:
+        # results loaded from the database have no private state and nothing left to insert
+        if self.__pydantic_private__ is None:
+            return BulkRows()
+        return self._bulk_rows
+
     def get_all_responses(self) -> list[Response]:
         responses = []
         for cluster in self.clusters:
@@ -442,22 +533,24 @@ class Run(SQLModel, table=True):
     result: Optional[ClusteringResult] = Relationship(back_populates="run")
 
     def __init__(self, **data):
+        # The default name uses the id, so the id is generated up front
+        data.setdefault("id", uuid.uuid4())
+        if not data.get("name"):
+            data["name"] = f"Run {data['id']}"
         super().__init__(**data)
-        # self.name = f"Cluster {self.id}"
-        self.__dict__["name"] = f"Run {self.id}"
 
+    # The paths are part of every serialized run, so they are memoized and the results
+    # directory is only created when the files are actually written
     @computed_field
-    @property
+    @cached_property
     def output_file_path(self) -> str:
         results_dir = f"{get_user_data_path()}/results/{self.id}"
-        os.makedirs(results_dir, exist_ok=True)
         output_file_path = f"{results_dir}/output.csv"
         return output_file_path
 
     @computed_field
-    @property
+    @cached_property
     def assignments_file_path(self) -> str:
         results_dir = f"{get_user_data_path()}/results/{self.id}"
-        os.makedirs(results_dir, exist_ok=True)
         assignments_file_path = f"{results_dir}/assignments.csv"
         return assignments_file_path
@@ -28,6 +28,8 @@ def print_progress(
         type="progress",
         data=ProgressMessage(step=step, status=status, timestamp=time.time()),
     )
-    print(progress_message.model_dump_json(), flush=True, end="\n\n\n")
-    logger.info(progress_message.model_dump_json())
+    # Serialized once for both the IPC channel and the log
+    progress_json = progress_message.model_dump_json()
+    print(progress_json, flush=True, end="\n\n\n")
+    logger.info(progress_json)
     time.sleep(0.01)
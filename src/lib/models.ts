@@ -185,6 +185,7 @@ export interface AlgorithmSettings {
   seed?: number;
   outlier_detection?: OutlierDetectionSettings;
   agglomerative_clustering?: AgglomerativeClusteringSettings;
+  debug_plots?: boolean;
 }
 
 export interface Response {